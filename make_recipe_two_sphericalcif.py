@@ -23,7 +23,6 @@ def make_recipe_two_sphericalcif(cif_path1, cif_path2, dat_path):
     
     sg1 = p_cif1.spacegroup.short_name
     sg2 = p_cif2.spacegroup.short_name
-    RUN_PARALLEL=True
     # 10: Create a Profile object for the experimental dataset and
     # tell this profile the range and mesh of points in r-space.
     profile = Profile()
@@ -0,0 +1,306 @@
+import multiprocessing
+
+import numpy as np
+
+from recipe_replica import build_recipe_replica
+
+# Replicated recipe held by each worker process (see _init_jacobian_worker).
+_worker_recipe = None
+_worker_error = None
+
+
+def _init_jacobian_worker(make_recipe, recipe_args, values, free_names):
+    """
+    Builds the replicated Fit Recipe of a worker process.
+
+    Parameters
+    ----------
+    make_recipe :   function, one of the make_recipe_* functions.
+    recipe_args :   tuple, arguments passed to make_recipe.
+    values :        dict, current value of every recipe variable.
+    free_names :    list of string, names of the refined variables, in the
+                    order of the parent recipe.
+
+    Returns
+    ----------
+    None
+    """
+    global _worker_recipe, _worker_error
+    # An exception raised here would make the pool restart the worker
+    # forever: keep it and raise it from the first evaluation instead.
+    try:
+        _worker_recipe = build_recipe_replica(make_recipe, recipe_args,
+                                              values, free_names)
+    except Exception as error:
+        if not isinstance(error, RuntimeError):
+            error = RuntimeError("%s: %s" % (type(error).__name__, error))
+        _worker_error = error
+
+
+def _perturbed_residual(job):
+    """
+    Evaluates the residual of the worker recipe with one variable perturbed.
+
+    Parameters
+    ----------
+    job :   tuple (p, index, h), the variable values, the index of the
+            variable to perturb and the finite-difference step.
+
+    Returns
+    ----------
+    index, residual : the index of the perturbed variable and the residual
+                      vector evaluated at the perturbed values.
+
+    Raises
+    ----------
+    RuntimeError if the recipe could not be built in the worker process.
+    """
+    if _worker_error is not None:
+        raise _worker_error
+    p, index, h = job
+    p_step = np.array(p, dtype=float)
+    p_step[index] += h
+    return index, _worker_recipe.residual(p_step)
+
+
+def _linear_scale_column(recipe, index, name, p, f0, h):
+    """
+    Computes the Jacobian column of a variable that scales every contribution.
+
+    The contribution rows are analytic: srfit computes chiv = (ycalc - y) / dy
+    so d(chiv)/ds = ycalc / (s * dy).
+    The restraint rows are differentiated from the analytic contribution
+    rows, without evaluating the generators.
+
+    Parameters
+    ----------
+    recipe :    The Fit Recipe object, evaluated at p.
+    index :     int, index of the variable in p.
+    name :      string, name of the variable.
+    p :         array, current values of the refined variables.
+    f0 :        array, residual of recipe at p.
+    h :         float, step used for the restraint rows.
+
+    Returns
+    ----------
+    column : array, the Jacobian column of the variable.
+    """
+    scale = p[index]
+    column = np.zeros(len(f0))
+    rows = []
+    for weight, contribution in zip(recipe._weights,
+                                    recipe._contributions.values()):
+        profile = contribution.profile
+        rows.append(weight * np.asarray(profile.ycalc)
+                    / (scale * np.asarray(profile.dy)))
+    rows = np.concatenate(rows)
+    npts = len(rows)
+    column[:npts] = rows
+
+    if len(recipe._restraintlist) > 0:
+        chiv = f0[:npts] + h * rows
+        w = np.dot(chiv, chiv) / npts
+        var = recipe.get(name)
+        var.setValue(scale + h)
+        penalties = np.array([np.sqrt(res.penalty(w))
+                              for res in recipe._restraintlist])
+        var.setValue(scale)
+        column[npts:] = (penalties - f0[npts:]) / h
+    return column
+
+
+def _local_columns(recipe, indices, p, f0, steps):
+    """
+    Computes forward-difference Jacobian columns in the main process.
+
+    Parameters
+    ----------
+    recipe :    The Fit Recipe object, evaluated at p.
+    indices :   list of int, indices of the variables to differentiate.
+    p :         array, current values of the refined variables.
+    f0 :        array, residual of recipe at p.
+    steps :     array, finite-difference step of each variable.
+
+    Returns
+    ----------
+    columns : dict mapping each index to its Jacobian column.
+    """
+    columns = {}
+    for i in indices:
+        p_step = np.array(p)
+        p_step[i] += steps[i]
+        columns[i] = (recipe.residual(p_step) - f0) / steps[i]
+    if len(indices) > 0:
+        recipe.residual(p)
+    return columns
+
+
+def _check_linear_scales(recipe, indices, names, p, f0, steps):
+    """
+    Checks that the analytic columns of the linear scale variables agree
+    with a forward difference.
+
+    Parameters
+    ----------
+    recipe :    The Fit Recipe object, evaluated at p.
+    indices :   list of int, indices of the linear scale variables.
+    names :     list of string, names of the refined variables.
+    p :         array, current values of the refined variables.
+    f0 :        array, residual of recipe at p.
+    steps :     array, finite-difference step of each variable.
+
+    Returns
+    ----------
+    None
+
+    Raises
+    ----------
+    ValueError if a variable does not multiply the whole calculated profile.
+    """
+    npts = len(f0) - len(recipe._restraintlist)
+    for i in indices:
+        if p[i] == 0:
+            continue
+        analytic = _linear_scale_column(recipe, i, names[i], p, f0,
+                                        steps[i])[:npts]
+        difference = _local_columns(recipe, [i], p, f0, steps)[i][:npts]
+        if not np.allclose(analytic, difference, rtol=1e-4,
+                           atol=1e-4 * np.max(np.abs(difference))):
+            raise ValueError("'%s' does not multiply the whole calculated "
+                             "profile, pass it in local instead of linear"
+                             % names[i])
+
+
+def make_parallel_jacobian(make_recipe, recipe_args, recipe, linear=(),
+                           local=(), ncpu=None, rel_step=None):
+    """
+    Creates a Jacobian function for least-squares refinement that spreads the
+    finite-difference evaluations over worker processes.
+
+    Each worker holds a replicated Fit Recipe built once with make_recipe and
+    evaluates the columns of the variables that enter the generators. The
+    workers cannot open their own process pool: build the recipes with
+    RUN_PARALLEL = False.
+
+    The overall scale factor, which multiplies the whole calculated profile,
+    has an analytic column. It is s1 in make_recipe_sphericalcif_plus_xyz and
+    make_recipe_size_distribution, s2 in make_recipe_two_xyz and
+    make_recipe_two_sphericalcif. Each analytic column is checked against a
+    forward difference the first time its scale is non-zero.
+
+    The other variables that only enter the contribution equation (phase
+    fractions, envelope parameters such as psize) are forward-differenced on
+    the main process, while the workers run. Changing them does not change
+    the generator outputs, which srfit keeps cached.
+
+    The speed-up is below the number of workers: all the variables move
+    between two optimiser steps, so the first column a worker evaluates in
+    a step recomputes every generator of its recipe.
+
+    Parameters
+    ----------
+    make_recipe :   function, the make_recipe_* function used to build recipe.
+    recipe_args :   tuple, the arguments passed to make_recipe to build recipe.
+    recipe :        The Fit Recipe object to refine. The free variables must
+                    not change while the Jacobian is in use.
+    linear :        list of string, the overall scale variable, differentiated
+                    analytically (e.g. "s1" in make_recipe_sphericalcif_plus_xyz).
+    local :         list of string, other variables that do not enter the
+                    generators (e.g. "s2", "psize"), forward-differenced on
+                    the main process.
+    ncpu :          int, number of worker processes. Defaults to all cores.
+    rel_step :      float, relative finite-difference step. Defaults to the
+                    square root of the machine precision.
+
+    Returns
+    ----------
+    jacobian :  function of the variable values returning the Jacobian of
+                recipe.residual, to be passed as jac to
+                scipy.optimize.least_squares.
+    pool :      The process pool of the workers, to terminate after the
+                refinement.
+
+    Example
+    ----------
+    jacobian, pool = make_parallel_jacobian(make_recipe_sphericalcif_plus_xyz,
+                                            (cif_path1, stru_path, dat_path, True),
+                                            recipe, linear=["s1"],
+                                            local=["s2", "psize"])
+    least_squares(recipe.residual, recipe.values, jac=jacobian, x_scale="jac")
+    pool.terminate()
+
+    Raises
+    ----------
+    ValueError if a name of linear or local is not a refined variable, or if
+    a variable of linear does not multiply the whole calculated profile.
+    The pool is terminated when a call raises.
+    RuntimeError if make_recipe fails in a worker process.
+    """
+    names = recipe.getNames()
+    for name in list(linear) + list(local):
+        if name not in names:
+            raise ValueError("'%s' is not a refined variable" % name)
+    linear_index = [names.index(name) for name in linear]
+    local_index = [names.index(name) for name in local
+                   if name not in linear]
+    remote_index = [i for i in range(len(names))
+                    if i not in linear_index and i not in local_index]
+    if rel_step is None:
+        rel_step = np.sqrt(np.finfo(float).eps)
+
+    if ncpu is None:
+        ncpu = multiprocessing.cpu_count()
+    ncpu = int(np.max([1, np.min([ncpu, len(remote_index)])]))
+    values = {name: par.value for name, par in recipe._parameters.items()}
+    pool = multiprocessing.Pool(processes=ncpu,
+                                initializer=_init_jacobian_worker,
+                                initargs=(make_recipe, recipe_args, values,
+                                          names))
+    print("Jacobian: %d columns on %d processes, %d analytic, %d local\n"
+          % (len(remote_index), ncpu, len(linear_index), len(local_index)))
+
+    # Indices of the linear scales whose analytic column agreed with a
+    # forward difference. A scale at zero is checked once it is non-zero.
+    checked = set()
+
+    def evaluate(p):
+        p = np.asarray(p, dtype=float)
+        steps = rel_step * np.maximum(1.0, np.abs(p))
+        unchecked = [i for i in linear_index if i not in checked and p[i] != 0]
+        if len(unchecked) > 0:
+            _check_linear_scales(recipe, unchecked, names, p,
+                                 recipe.residual(p), steps)
+            checked.update(unchecked)
+
+        # Send the costly columns to the workers first, so they run while the
+        # main process evaluates the residual and the cheap columns.
+        jobs = [(p, i, steps[i]) for i in remote_index]
+        pending = pool.map_async(_perturbed_residual, jobs, chunksize=1)
+
+        f0 = recipe.residual(p)
+        jac = np.zeros((len(f0), len(p)))
+        for i in linear_index:
+            if p[i] != 0:
+                jac[:, i] = _linear_scale_column(recipe, i, names[i], p, f0,
+                                                 steps[i])
+        # A scale at zero has no analytic column: difference it like the
+        # other local variables.
+        fallback = [i for i in linear_index if p[i] == 0]
+        columns = _local_columns(recipe, fallback + local_index, p, f0, steps)
+        for i, column in columns.items():
+            jac[:, i] = column
+
+        for i, residual in pending.get():
+            jac[:, i] = (residual - f0) / steps[i]
+        return jac
+
+    def jacobian(p, *args, **kwargs):
+        # Do not leave the workers running when the evaluation fails.
+        try:
+            return evaluate(p)
+        except BaseException:
+            pool.terminate()
+            raise
+
+    return jacobian, pool
+
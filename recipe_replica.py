@@ -0,0 +1,66 @@
+def build_recipe_replica(make_recipe, recipe_args, values, free_names):
+    """
+    Builds a copy of a Fit Recipe in a worker process and sets it to the
+    variable values and refined variables of the original recipe.
+
+    The recipes cannot open their own process pool (RUN_PARALLEL) inside a
+    pool worker: the recipe must then be built with RUN_PARALLEL = False.
+    The fit hooks of the copy are cleared, so the workers do not print an
+    iteration counter at every residual evaluation.
+
+    Parameters
+    ----------
+    make_recipe :   function, the make_recipe_* function used to build the
+                    original recipe.
+    recipe_args :   tuple, arguments passed to make_recipe.
+    values :        dict, value of every variable of the original recipe.
+    free_names :    list of string, names of the refined variables, in the
+                    order of the original recipe.
+
+    Returns
+    ----------
+    recipe :    The replicated Fit Recipe object.
+
+    Raises
+    ----------
+    RuntimeError if make_recipe fails in the worker process or if the copy
+    does not have the variables of the original recipe.
+    """
+    # Any exception leaving this function must be a RuntimeError: the pool
+    # initializers only keep those and the pool restarts the workers forever
+    # on the others.
+    try:
+        try:
+            recipe = make_recipe(*recipe_args)
+        except Exception as error:
+            message = ("%s failed in a worker process (%s: %s)."
+                       % (make_recipe.__name__, type(error).__name__, error))
+            if (isinstance(error, AssertionError)
+                    and "daemonic processes" in str(error)):
+                message += (" Recipes that run their generators in parallel "
+                            "cannot be built inside a process pool, set "
+                            "RUN_PARALLEL = False for this recipe.")
+            raise RuntimeError(message)
+
+        missing = [name for name in list(values) + list(free_names)
+                   if name not in recipe._parameters]
+        if len(missing) > 0:
+            raise RuntimeError(
+                "The recipe built by %s in a worker process misses the "
+                "variables %s of the original recipe: check that recipe_args "
+                "are those used to build it."
+                % (make_recipe.__name__, ", ".join(sorted(set(missing)))))
+
+        recipe.clearFitHooks()
+        recipe.fix("all")
+        for name, value in values.items():
+            recipe.get(name).value = value
+        recipe.free(*free_names)
+    except RuntimeError:
+        raise
+    except Exception as error:
+        raise RuntimeError(
+            "The recipe built by %s in a worker process cannot be set to the "
+            "original recipe (%s: %s)."
+            % (make_recipe.__name__, type(error).__name__, error))
+    return recipe
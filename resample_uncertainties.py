@@ -0,0 +1,277 @@
+import multiprocessing
+
+import numpy as np
+from scipy.optimize import least_squares
+
+from recipe_replica import build_recipe_replica
+
+# Recipe rebuilt once in each worker process and reused for every replicate
+# handled by that worker (see _init_resample_worker).
+_worker_recipe = None
+_worker_contribution = None
+_worker_error = None
+
+
+def _init_resample_worker(make_recipe, recipe_args, values, free_names,
+                          contribution_name):
+    """
+    Builds the Fit Recipe of a worker process and sets it to the refined solution.
+
+    Parameters
+    ----------
+    make_recipe :       function, one of the make_recipe_* functions.
+    recipe_args :       tuple, arguments passed to make_recipe.
+    values :            dict, value of every recipe variable at the solution.
+    free_names :        list of string, names of the refined variables.
+    contribution_name : string, name of the Fit Contribution to resample.
+
+    Returns
+    ----------
+    None
+    """
+    global _worker_recipe, _worker_contribution, _worker_error
+    # An exception raised here would make the pool restart the worker
+    # forever: keep it and raise it from the first replicate instead.
+    try:
+        _worker_recipe = build_recipe_replica(make_recipe, recipe_args,
+                                              values, free_names)
+        _worker_contribution = getattr(_worker_recipe, contribution_name)
+    except Exception as error:
+        if not isinstance(error, RuntimeError):
+            error = RuntimeError("%s: %s" % (type(error).__name__, error))
+        _worker_error = error
+
+
+def _refine_replicate(job):
+    """
+    Refines one resampled replicate of the profile, warm-started from the solution.
+
+    Parameters
+    ----------
+    job :   tuple (x0, y, dy), the refined solution and the resampled profile.
+
+    Returns
+    ----------
+    values : array of the refined variables of the replicate, or None if the
+             refinement failed.
+
+    Raises
+    ----------
+    RuntimeError if the recipe could not be built in the worker process.
+    """
+    if _worker_error is not None:
+        raise _worker_error
+    x0, y, dy = job
+    profile = _worker_contribution.profile
+    profile.y = y
+    profile.dy = dy
+    try:
+        result = least_squares(_worker_recipe.residual, x0, x_scale="jac")
+    except Exception as error:
+        print("Replicate refinement failed: %s" % error)
+        return None
+    return result.x
+
+
+def _block_starts(npts, block, rng):
+    """
+    Draws the first index of the blocks of a moving-block bootstrap.
+
+    Parameters
+    ----------
+    npts :  int, number of points of the profile.
+    block : int, number of points of a block.
+    rng :   numpy Generator used for the draw.
+
+    Returns
+    ----------
+    starts : array of int, first index of each of the ceil(npts/block) blocks.
+    """
+    nblocks = int(np.ceil(npts / float(block)))
+    return rng.integers(0, npts - block + 1, nblocks)
+
+
+def _resample_profile(y, ycalc, dy, method, block, rng):
+    """
+    Generates one resampled replicate of the observed profile.
+
+    The points of a PDF are sampled much more finely than its Nyquist step,
+    so neighbouring residuals are correlated. Both methods therefore draw
+    contiguous blocks of points (moving-block bootstrap) instead of single
+    points, which would give too narrow confidence intervals.
+
+    Parameters
+    ----------
+    y :      array, the observed profile over the calculation range.
+    ycalc :  array, the calculated profile at the refined solution.
+    dy :     array, the uncertainty on the observed profile.
+    method : string, "residual" or "bootstrap".
+    block :  int, number of points of the resampled blocks.
+    rng :    numpy Generator used for the draw.
+
+    Returns
+    ----------
+    y_star, dy_star : arrays, the resampled profile and its uncertainty.
+    """
+    npts = len(y)
+    block = int(np.clip(block, 1, npts))
+    if method == "residual":
+        # Add blocks of residuals drawn with replacement to the calculated
+        # profile.
+        residuals = y - ycalc
+        starts = _block_starts(npts, block, rng)
+        indices = (starts[:, None] + np.arange(block)).ravel()[:npts]
+        y_star = ycalc + residuals[indices]
+        return y_star, dy
+    if method == "bootstrap":
+        # Draw blocks of data points with replacement. The r-grid cannot be
+        # reordered, so a point drawn n times gets its weight multiplied by n
+        # and a point never drawn drops out of the residual.
+        counts = np.zeros(npts)
+        for start in _block_starts(npts, block, rng):
+            counts[start:start + block] += 1
+        with np.errstate(divide="ignore"):
+            dy_star = dy / np.sqrt(counts)
+        return y, dy_star
+    raise ValueError("Unknown resampling method '%s'" % method)
+
+
+def _default_block_length(contribution):
+    """
+    Returns the Nyquist step pi/Qmax of the PDF generators of a contribution.
+
+    Parameters
+    ----------
+    contribution : The Fit Contribution to resample.
+
+    Returns
+    ----------
+    block_length : float, pi/Qmax for the smallest Qmax of the generators.
+
+    Raises
+    ----------
+    ValueError if the contribution has no PDF generator.
+    """
+    qmax = [generator.getQmax()
+            for generator in contribution._generators.values()
+            if hasattr(generator, "getQmax")]
+    if len(qmax) == 0:
+        raise ValueError("No PDF generator in the contribution, "
+                         "block_length must be given")
+    return np.pi / min(qmax)
+
+
+def resample_uncertainties(make_recipe, recipe_args, recipe,
+                           contribution_name=None, method="residual",
+                           n_replicates=100, block_length=None,
+                           confidence=0.95, ncpu=None, seed=None):
+    """
+    Estimates parameter uncertainties by refining resampled replicates of
+    the profile across a process pool.
+
+    Each worker builds its own Fit Recipe once with make_recipe and reuses it
+    for all the replicates it refines, only the observed profile is replaced.
+    Every replicate is warm-started from the refined solution.
+
+    The profile is resampled by blocks of contiguous points (moving-block
+    bootstrap), block_length long, because the residuals of neighbouring
+    points of a PDF are correlated over about pi/Qmax. The workers
+    cannot open their own process pool: build the recipes with
+    RUN_PARALLEL = False.
+
+    Parameters
+    ----------
+    make_recipe :       function, the make_recipe_* function used to build recipe.
+    recipe_args :       tuple, the arguments passed to make_recipe to build recipe.
+    recipe :            The refined Fit Recipe object. Its free variables are
+                        those refined for each replicate.
+    contribution_name : string, name of the Fit Contribution to resample
+                        (e.g. "crystal" or "cluster"). Defaults to the first one.
+    method :            string, "residual" to resample the fit residuals or
+                        "bootstrap" to resample the data points.
+    n_replicates :      int, number of resampled replicates to refine.
+    block_length :      float, length of the resampled blocks in units of the
+                        profile x (e.g. r in A). Defaults to pi/Qmax of the
+                        PDF generators of the contribution.
+    confidence :        float, level of the confidence intervals.
+    ncpu :              int, number of worker processes. Defaults to all cores.
+    seed :              int, seed of the random draws, for reproducible results.
+
+    Returns
+    ----------
+    results : dict with keys
+              "names" :     list of the refined variable names,
+              "solution" :  array of the values in recipe,
+              "samples" :   array (n_successful, n_variables) of refined values,
+              "mean", "std" : arrays, mean and standard deviation of the samples,
+              "ci_low", "ci_high" : arrays, bounds of the confidence intervals.
+
+    Raises
+    ----------
+    ValueError if block_length is not given and the contribution has no PDF
+    generator.
+    RuntimeError if make_recipe fails in a worker process or if all the
+    replicate refinements fail.
+    """
+    if contribution_name is None:
+        contribution_name = list(recipe._contributions.keys())[0]
+    contribution = getattr(recipe, contribution_name)
+
+    names = recipe.getNames()
+    solution = recipe.getValues()
+    values = {name: par.value for name, par in recipe._parameters.items()}
+
+    # The calculated profile at the solution does not depend on the resampled
+    # data: evaluate it once and share it between all the replicates.
+    recipe.residual(solution)
+    profile = contribution.profile
+    y = np.array(profile.y)
+    dy = np.array(profile.dy)
+    ycalc = np.array(profile.ycalc)
+
+    if block_length is None:
+        block_length = _default_block_length(contribution)
+    x = np.asarray(profile.x)
+    block = max(1, int(round(block_length / ((x[-1] - x[0]) / (len(x) - 1.0)))))
+
+    rngs = [np.random.default_rng(s)
+            for s in np.random.SeedSequence(seed).spawn(n_replicates)]
+    jobs = []
+    for rng in rngs:
+        y_star, dy_star = _resample_profile(y, ycalc, dy, method, block, rng)
+        jobs.append((solution, y_star, dy_star))
+
+    if ncpu is None:
+        ncpu = multiprocessing.cpu_count()
+    ncpu = int(np.max([1, np.min([ncpu, n_replicates])]))
+    print("Refining %d %s replicates (blocks of %d points) on %d processes\n"
+          % (n_replicates, method, block, ncpu))
+    with multiprocessing.Pool(processes=ncpu,
+                              initializer=_init_resample_worker,
+                              initargs=(make_recipe, recipe_args, values,
+                                        names, contribution_name)) as pool:
+        refined = pool.map(_refine_replicate, jobs)
+
+    samples = np.array([x for x in refined if x is not None])
+    if len(samples) < n_replicates:
+        print("%d replicates failed and were discarded\n"
+              % (n_replicates - len(samples)))
+    if len(samples) == 0:
+        raise RuntimeError("All replicate refinements failed")
+
+    alpha = 100.0 * (1.0 - confidence) / 2.0
+    results = {
+        "names": names,
+        "solution": solution,
+        "samples": samples,
+        "mean": samples.mean(axis=0),
+        "std": samples.std(axis=0, ddof=1) if len(samples) > 1
+        else np.zeros(len(names)),
+        "ci_low": np.percentile(samples, alpha, axis=0),
+        "ci_high": np.percentile(samples, 100.0 - alpha, axis=0),
+    }
+    for i, name in enumerate(names):
+        print("%-20s %12.6g +/- %-12.6g [%g, %g]"
+              % (name, solution[i], results["std"][i],
+                 results["ci_low"][i], results["ci_high"][i]))
+    return results
@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+from diffpy.srfit.fitbase import FitContribution, FitRecipe, Profile
+
+from parallel_jacobian import make_parallel_jacobian
+
+
+def make_toy_recipe(restrained, fail=False):
+    """
+    Creates a two-phase toy Fit Recipe, s1*(s2*peak + (1-s2)*decay), where
+    s1 is the overall scale and s2 the phase fraction.
+    """
+    if fail:
+        raise ValueError("toy recipe failure")
+    x = np.linspace(0.0, 10.0, 201)
+    y = 1.8 * (0.6 * np.exp(-(x - 4.0) ** 2 / 1.5)
+               + 0.4 * np.exp(-x / 3.0))
+    profile = Profile()
+    profile.setObservedProfile(x, y, 0.01 * np.ones_like(x))
+    contribution = FitContribution("toy")
+    contribution.setProfile(profile, xname="x")
+    contribution.setEquation(
+        "s1*(s2*exp(-(x-c0)**2/width) + (1.0-s2)*exp(-x/decay))")
+    recipe = FitRecipe()
+    recipe.addContribution(contribution)
+    recipe.addVar(contribution.s1, 1.3)
+    recipe.addVar(contribution.s2, 0.5)
+    recipe.addVar(contribution.c0, 4.3)
+    recipe.addVar(contribution.width, 1.2)
+    recipe.addVar(contribution.decay, 2.5)
+    if restrained:
+        # s1 = 1.3 lies above the upper bound: the restraint is active.
+        recipe.restrain("s1", lb=0.0, ub=1.0, scaled=True, sig=0.001)
+    return recipe
+
+
+def forward_difference(recipe, p):
+    """Serial forward-difference Jacobian of recipe.residual."""
+    f0 = recipe.residual(p)
+    jac = np.zeros((len(f0), len(p)))
+    for i in range(len(p)):
+        h = np.sqrt(np.finfo(float).eps) * max(1.0, abs(p[i]))
+        p_step = np.array(p)
+        p_step[i] += h
+        jac[:, i] = (recipe.residual(p_step) - f0) / h
+    recipe.residual(p)
+    return jac
+
+
+@pytest.mark.parametrize("restrained", [False, True])
+def test_jacobian_matches_forward_difference(restrained):
+    recipe = make_toy_recipe(restrained)
+    p = recipe.getValues()
+    expected = forward_difference(make_toy_recipe(restrained), p)
+    jacobian, pool = make_parallel_jacobian(make_toy_recipe, (restrained,),
+                                            recipe, linear=["s1"],
+                                            local=["s2"], ncpu=2)
+    try:
+        jac = jacobian(p)
+    finally:
+        pool.terminate()
+    assert jac.shape == expected.shape
+    for i in range(len(p)):
+        np.testing.assert_allclose(
+            jac[:, i], expected[:, i], rtol=1e-4,
+            atol=1e-4 * np.max(np.abs(expected[:, i])))
+
+
+def test_linear_rejects_phase_fraction():
+    recipe = make_toy_recipe(False)
+    jacobian, pool = make_parallel_jacobian(make_toy_recipe, (False,),
+                                            recipe, linear=["s2"], ncpu=2)
+    try:
+        with pytest.raises(ValueError, match="s2"):
+            jacobian(recipe.getValues())
+    finally:
+        pool.terminate()
+
+
+def test_worker_recipe_failure_raises():
+    recipe = make_toy_recipe(False)
+    jacobian, pool = make_parallel_jacobian(make_toy_recipe, (False, True),
+                                            recipe, linear=["s1"], ncpu=2)
+    try:
+        with pytest.raises(RuntimeError, match="make_toy_recipe"):
+            jacobian(recipe.getValues())
+    finally:
+        pool.terminate()
+
+
+def test_linear_scale_checked_once_non_zero():
+    recipe = make_toy_recipe(False)
+    jacobian, pool = make_parallel_jacobian(make_toy_recipe, (False,),
+                                            recipe, linear=["s2"], ncpu=2)
+    p = recipe.getValues()
+    p[1] = 0.0
+    try:
+        jacobian(p)
+        p[1] = 0.5
+        with pytest.raises(ValueError, match="s2"):
+            jacobian(p)
+    finally:
+        pool.terminate()
+
+
+def test_worker_recipe_missing_variable_raises():
+    recipe = make_toy_recipe(False)
+    recipe.newVar("extra", 1.0)
+    jacobian, pool = make_parallel_jacobian(make_toy_recipe, (False,),
+                                            recipe, linear=["s1"], ncpu=2)
+    try:
+        with pytest.raises(RuntimeError, match="extra"):
+            jacobian(recipe.getValues())
+    finally:
+        pool.terminate()
+
+
+def test_pool_terminated_on_any_error():
+    recipe = make_toy_recipe(False)
+    jacobian, pool = make_parallel_jacobian(make_toy_recipe, (False,),
+                                            recipe, linear=["s1"], ncpu=2)
+    try:
+        with pytest.raises(IndexError):
+            jacobian(recipe.getValues()[:2])
+        with pytest.raises(ValueError):
+            pool.apply(abs, (-1,))
+    finally:
+        pool.terminate()
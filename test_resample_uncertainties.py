@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+from diffpy.srfit.fitbase import FitContribution, FitRecipe, Profile
+from scipy.optimize import least_squares
+
+from recipe_replica import build_recipe_replica
+from resample_uncertainties import (_block_starts, _resample_profile,
+                                    resample_uncertainties)
+
+
+def make_toy_recipe(refine_width=True, fail=False):
+    """
+    Creates a toy Fit Recipe, s1*exp(-(x-c0)**2/width), fitted to a noisy
+    peak.
+    """
+    if fail:
+        raise ValueError("toy recipe failure")
+    x = np.linspace(0.0, 10.0, 201)
+    noise = np.random.default_rng(42).normal(0.0, 0.01, len(x))
+    y = 1.8 * np.exp(-(x - 4.0) ** 2 / 1.5) + noise
+    profile = Profile()
+    profile.setObservedProfile(x, y, 0.01 * np.ones_like(x))
+    contribution = FitContribution("toy")
+    contribution.setProfile(profile, xname="x")
+    contribution.setEquation("s1*exp(-(x-c0)**2/width)")
+    recipe = FitRecipe()
+    recipe.clearFitHooks()
+    recipe.addContribution(contribution)
+    recipe.addVar(contribution.s1, 1.5)
+    recipe.addVar(contribution.c0, 4.2)
+    if refine_width:
+        recipe.addVar(contribution.width, 1.2)
+    else:
+        contribution.width.value = 1.5
+    return recipe
+
+
+def refined_toy_recipe():
+    recipe = make_toy_recipe()
+    least_squares(recipe.residual, recipe.values, x_scale="jac")
+    return recipe
+
+
+def test_residual_method_adds_resampled_residual_blocks():
+    y = np.sin(np.linspace(0.0, 5.0, 50))
+    ycalc = 0.9 * y
+    dy = np.linspace(0.1, 0.2, 50)
+    y_star, dy_star = _resample_profile(y, ycalc, dy, "residual", 7,
+                                        np.random.default_rng(0))
+    starts = _block_starts(50, 7, np.random.default_rng(0))
+    indices = (starts[:, None] + np.arange(7)).ravel()[:50]
+    np.testing.assert_array_equal(y_star, ycalc + (y - ycalc)[indices])
+    np.testing.assert_array_equal(dy_star, dy)
+
+
+def test_bootstrap_method_drops_points_never_drawn():
+    y = np.sin(np.linspace(0.0, 5.0, 50))
+    dy = np.linspace(0.1, 0.2, 50)
+    y_star, dy_star = _resample_profile(y, 0.9 * y, dy, "bootstrap", 7,
+                                        np.random.default_rng(0))
+    counts = np.zeros(50)
+    for start in _block_starts(50, 7, np.random.default_rng(0)):
+        counts[start:start + 7] += 1
+    assert np.any(counts == 0)
+    np.testing.assert_array_equal(y_star, y)
+    assert np.all(dy_star[counts == 0] == np.inf)
+    np.testing.assert_allclose(dy_star[counts > 0],
+                               dy[counts > 0] / np.sqrt(counts[counts > 0]))
+
+
+def test_same_seed_gives_same_samples():
+    recipe = refined_toy_recipe()
+    first = resample_uncertainties(make_toy_recipe, (), recipe,
+                                   n_replicates=6, block_length=0.3,
+                                   ncpu=2, seed=7)
+    second = resample_uncertainties(make_toy_recipe, (), recipe,
+                                    n_replicates=6, block_length=0.3,
+                                    ncpu=2, seed=7)
+    np.testing.assert_array_equal(first["samples"], second["samples"])
+
+
+def test_uncertainties_bracket_solution():
+    recipe = refined_toy_recipe()
+    for method in ["residual", "bootstrap"]:
+        results = resample_uncertainties(make_toy_recipe, (), recipe,
+                                         method=method, n_replicates=20,
+                                         block_length=0.3, ncpu=2, seed=3)
+        assert results["samples"].shape == (20, 3)
+        for key in ["std", "ci_low", "ci_high"]:
+            assert np.all(np.isfinite(results[key]))
+        assert np.all(results["std"] > 0)
+        assert np.all(results["ci_low"] <= results["solution"])
+        assert np.all(results["solution"] <= results["ci_high"])
+
+
+def test_worker_recipe_failure_raises():
+    recipe = refined_toy_recipe()
+    with pytest.raises(RuntimeError, match="toy recipe failure"):
+        resample_uncertainties(make_toy_recipe, (True, True), recipe,
+                               n_replicates=2, block_length=0.3, ncpu=2)
+
+
+def test_worker_recipe_missing_variable_raises():
+    recipe = refined_toy_recipe()
+    with pytest.raises(RuntimeError, match="width"):
+        resample_uncertainties(make_toy_recipe, (False,), recipe,
+                               n_replicates=2, block_length=0.3, ncpu=2)
+
+
+def test_replica_reports_original_error():
+    with pytest.raises(RuntimeError) as info:
+        build_recipe_replica(make_toy_recipe, (True, True), {}, [])
+    assert "ValueError: toy recipe failure" in str(info.value)
+    assert "RUN_PARALLEL" not in str(info.value)